@@ -1,24 +1,35 @@
 from __future__ import annotations
 
+import hashlib
 import os
 import threading
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
 
 import pandas as pd
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request
 
 try:
-    from .nifti_min import get_volume_info, render_slice_png  # type: ignore
+    from .nifti_min import (  # type: ignore
+        configure_nii_cache,
+        get_volume_info,
+        is_volume_cached,
+        preload_volume,
+        render_slice_png,
+    )
     from .storage import LabelStore  # type: ignore
 except Exception:  # pragma: no cover
-    from nifti_min import get_volume_info, render_slice_png
+    from nifti_min import configure_nii_cache, get_volume_info, is_volume_cached, preload_volume, render_slice_png
     from storage import LabelStore
 
 
 ROOT = Path(__file__).resolve().parents[1]  # /home/Head
 EXCEL_PATH = ROOT / "数据_筛选结果.xlsx"
 STROKE_ROOT = Path("/home/Head_Stroke")
+LABELS_DB = ROOT / "labels" / "labels.sqlite"
+# Pre-SQLite store; imported into LABELS_DB once if the database is empty.
 LABELS_PATH = ROOT / "labels" / "labels.json"
 
 # In-memory cache for rendered slice images (speeds up scroll/drag with prefetch).
@@ -26,6 +37,39 @@ _SLICE_CACHE_MAX = int(os.environ.get("SLICE_CACHE_MAX", "256"))
 _SLICE_CACHE: "OrderedDict[tuple, bytes]" = OrderedDict()
 _SLICE_CACHE_LOCK = threading.Lock()
 
+# Slice image encoding: "png" (default) or "webp" (lossless; served only to
+# clients whose Accept header lists image/webp, PNG otherwise).
+_SLICE_FORMAT = (os.environ.get("SLICE_FORMAT") or "png").strip().lower()
+if _SLICE_FORMAT not in ("png", "webp"):
+    _SLICE_FORMAT = "png"
+
+# Second-level on-disk cache for rendered slices (survives restarts, far larger
+# than the in-memory one). Bounded by size via a periodic oldest-first sweep.
+_SLICE_DISK_DIR = ROOT / "instance" / "slice_cache"
+_SLICE_DISK_MAX_BYTES = int(float(os.environ.get("SLICE_DISK_CACHE_MB", "1024")) * 1024 * 1024)
+_SLICE_DISK_SWEEP_EVERY = 64
+_SLICE_DISK_LOCK = threading.Lock()
+_slice_disk_writes = 0
+# Disk writes and sweeps run here, off the request that missed the cache.
+_SLICE_DISK_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slice-disk")
+
+# Decompressed .nii copies of viewed volumes; reloads memory-map them instead of
+# inflating the .nii.gz again. 0 disables.
+configure_nii_cache(
+    str(ROOT / "instance" / "nii_cache"),
+    int(float(os.environ.get("NII_CACHE_MB", "8192")) * 1024 * 1024),
+)
+
+# Server-side prefetch: after each slice request, render index±1..±radius in the
+# background so the next step of a scroll hits the cache. 0 disables. Only runs
+# against the volume already in memory, and jobs are dropped once the viewer has
+# moved to another file or window setting.
+_PREFETCH_RADIUS = int(os.environ.get("SLICE_PREFETCH_RADIUS", "2"))
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="slice-prefetch")
+_PREFETCH_INFLIGHT: "dict[tuple, Future]" = {}  # guarded by _SLICE_CACHE_LOCK
+_prefetch_focus: tuple | None = None  # cache_key of the latest foreground request
+
+
 def _env_truthy(name: str, default: str = "0") -> bool:
     v = os.environ.get(name, default)
     return str(v).strip().lower() in ("1", "true", "yes", "y", "on")
@@ -37,8 +81,47 @@ def _norm_barcode(v: object) -> str:
     return str(v).strip()
 
 
+_CASE_COLUMNS = ("条码号", "cta_category", "CTA检查结论", "CTA报告：检查所见")
+
+# Parsed copy of the Excel sheet, reused across restarts while the Excel mtime matches.
+_CASES_PARQUET = ROOT / "instance" / "cases.parquet"
+_CASES_PARQUET_STAMP = ROOT / "instance" / "cases.mtime"
+
+
 def _load_cases() -> pd.DataFrame:
-    df = pd.read_excel(EXCEL_PATH, sheet_name="all_with_labels")
+    df = _load_cases_cached()
+    # Few distinct values: categorical codes make == filters and value_counts cheap.
+    df["cta_category"] = df["cta_category"].astype("category")
+    return df
+
+
+def _load_cases_cached() -> pd.DataFrame:
+    stamp = str(os.path.getmtime(EXCEL_PATH))
+    try:
+        if _CASES_PARQUET.exists() and _CASES_PARQUET_STAMP.read_text(encoding="utf-8") == stamp:
+            return pd.read_parquet(_CASES_PARQUET)
+    except Exception:
+        pass
+
+    df = _load_cases_from_excel()
+    try:
+        _CASES_PARQUET.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(_CASES_PARQUET, index=False)
+        _CASES_PARQUET_STAMP.write_text(stamp, encoding="utf-8")
+    except Exception:
+        # No parquet engine (pyarrow/fastparquet) installed, or instance/ not writable.
+        pass
+    return df
+
+
+def _load_cases_from_excel() -> pd.DataFrame:
+    # Only parse the columns we keep; dtype=str skips numeric inference on barcodes.
+    df = pd.read_excel(
+        EXCEL_PATH,
+        sheet_name="all_with_labels",
+        usecols=lambda c: c in _CASE_COLUMNS,
+        dtype=str,
+    )
     df = df.copy()
     df["条码号"] = df["条码号"].map(_norm_barcode)
     df["cta_category"] = df["cta_category"].map(_norm_barcode)
@@ -52,36 +135,194 @@ def _load_cases() -> pd.DataFrame:
         cols.append("CTA检查结论")
     if "CTA报告：检查所见" in df.columns:
         cols.append("CTA报告：检查所见")
-    return df[cols]
+    return df[cols].reset_index(drop=True)
+
 
+def _scan_stroke_dirs() -> dict[str, dict]:
+    """Map uppercased case folder name -> {"folder", "cta_files"} in one scandir pass.
 
-def _scan_stroke_dirs() -> dict[str, str]:
-    mapping: dict[str, str] = {}
+    DirEntry.is_dir()/is_file() answer from the directory listing itself, so
+    no per-entry stat() is needed except for symlinks.
+    """
+    index: dict[str, dict] = {}
     if not STROKE_ROOT.exists():
-        return mapping
-    for p in STROKE_ROOT.iterdir():
-        if not p.is_dir():
-            continue
-        mapping[p.name.upper()] = p.name
-    return mapping
+        return index
+    with os.scandir(STROKE_ROOT) as it:
+        for e in it:
+            if not e.is_dir():
+                continue
+            cta_files = []
+            try:
+                with os.scandir(e.path) as it2:
+                    for f in it2:
+                        n = f.name
+                        if n.upper().startswith("CTA") and n.lower().endswith(".nii.gz") and f.is_file():
+                            cta_files.append(n)
+            except Exception:
+                cta_files = []
+            cta_files.sort()
+            index[e.name.upper()] = {"folder": e.name, "cta_files": cta_files}
+    return index
 
 
 CASES_DF = _load_cases()
-DIR_MAP = _scan_stroke_dirs()
-LABELS = LabelStore(str(LABELS_PATH))
+STROKE_INDEX: dict[str, dict] = _scan_stroke_dirs()
+LABELS = LabelStore(str(LABELS_DB), legacy_json_path=str(LABELS_PATH))
+
+# Uppercased barcode -> positional row in CASES_DF (first occurrence wins, matching
+# the previous `row.iloc[0]` semantics of the boolean-mask lookup).
+BARCODE_TO_ROW: dict[str, int] = {}
+for _i, _b in enumerate(CASES_DF["条码号"].tolist()):
+    BARCODE_TO_ROW.setdefault(str(_b).upper(), _i)
+
+# CASES_DF is never mutated after load, so these are constant.
+TOTAL_COUNT = int(len(CASES_DF))
+TOTALS_BY_CAT: dict = CASES_DF["cta_category"].value_counts().to_dict()
+CATEGORIES: list[str] = sorted(
+    {c for c in CASES_DF["cta_category"].dropna().astype(str).tolist() if c.strip() != ""}
+)
+
+# Serialized /api/stats body, recomputed only when the label data changes.
+_STATS_CACHE: dict = {"version": None, "resp": None}
+_STATS_CACHE_LOCK = threading.Lock()
+
+
+def _slice_cache_digest(cache_key: tuple) -> str:
+    return hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()
+
+
+def _slice_disk_path(cache_key: tuple, fmt: str) -> Path | None:
+    if _SLICE_DISK_MAX_BYTES <= 0:
+        return None
+    return _SLICE_DISK_DIR / f"{_slice_cache_digest(cache_key)}.{fmt}"
 
-STROKE_INDEX: dict[str, dict] = {}
-for upper_name, real_name in DIR_MAP.items():
-    p = STROKE_ROOT / real_name
-    cta_files = []
+
+def _slice_disk_put(path: Path, data: bytes) -> None:
+    global _slice_disk_writes
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except OSError:
+        return
+    with _SLICE_DISK_LOCK:
+        _slice_disk_writes += 1
+        if _slice_disk_writes % _SLICE_DISK_SWEEP_EVERY != 0:
+            return
+    _slice_disk_sweep()
+
+
+def _slice_disk_sweep() -> None:
+    """Delete least-recently-used entries until the cache is under ~90% of its budget."""
+    entries = []
+    total = 0
     try:
-        for fp in p.iterdir():
-            if fp.is_file() and fp.name.upper().startswith("CTA") and fp.name.lower().endswith(".nii.gz"):
-                cta_files.append(fp.name)
+        with os.scandir(_SLICE_DISK_DIR) as it:
+            for e in it:
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    except OSError:
+        return
+    if total <= _SLICE_DISK_MAX_BYTES:
+        return
+    target = int(_SLICE_DISK_MAX_BYTES * 0.9)
+    entries.sort()
+    for _, size, fp in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(fp)
+        except OSError:
+            continue
+        total -= size
+
+
+def _slice_cache_put(cache_key: tuple, data: bytes) -> None:
+    with _SLICE_CACHE_LOCK:
+        _SLICE_CACHE[cache_key] = data
+        _SLICE_CACHE.move_to_end(cache_key)
+        while len(_SLICE_CACHE) > max(0, _SLICE_CACHE_MAX):
+            _SLICE_CACHE.popitem(last=False)
+
+
+def _render_slice_cached(path: Path, cache_key: tuple, cached_only: bool = False) -> bytes:
+    """Render the slice described by cache_key and store it in both cache levels."""
+    _, _, axis, index, window_center, window_width, max_size, fmt = cache_key
+    data = render_slice_png(
+        str(path),
+        axis=axis,
+        index=index,
+        window_center=window_center,
+        window_width=window_width,
+        max_size=max_size,
+        fmt=fmt,
+        cached_only=cached_only,
+    )
+    _slice_cache_put(cache_key, data)
+    disk_path = _slice_disk_path(cache_key, fmt)
+    if disk_path is not None:
+        _SLICE_DISK_POOL.submit(_slice_disk_put, disk_path, data)
+    return data
+
+
+def _same_series(a: tuple, b: tuple) -> bool:
+    # Same file/mtime/axis and render parameters; only the index may differ.
+    return a[:3] == b[:3] and a[4:] == b[4:]
+
+
+def _prefetch_one(path: Path, cache_key: tuple) -> bytes | None:
+    try:
+        focus = _prefetch_focus
+        if focus is None or not _same_series(focus, cache_key):
+            return None  # stale: the viewer has moved on
+        disk_path = _slice_disk_path(cache_key, cache_key[7])
+        if disk_path is not None and disk_path.exists():
+            return None
+        return _render_slice_cached(path, cache_key, cached_only=True)
+    except Exception:
+        return None
+    finally:
+        with _SLICE_CACHE_LOCK:
+            _PREFETCH_INFLIGHT.pop(cache_key, None)
+
+
+def _take_inflight(cache_key: tuple) -> bytes | None:
+    """Reuse a prefetch job for cache_key: wait if it is running, cancel it if queued."""
+    with _SLICE_CACHE_LOCK:
+        fut = _PREFETCH_INFLIGHT.get(cache_key)
+    if fut is None:
+        return None
+    if fut.cancel():
+        with _SLICE_CACHE_LOCK:
+            _PREFETCH_INFLIGHT.pop(cache_key, None)
+        return None
+    return fut.result()
+
+
+def _prefetch_neighbors(path: Path, cache_key: tuple) -> None:
+    global _prefetch_focus
+    _prefetch_focus = cache_key
+    if _PREFETCH_RADIUS <= 0 or not is_volume_cached(str(path)):
+        return
+    try:
+        depth = int(get_volume_info(str(path))["shape"]["xyz".index(cache_key[2])])
     except Exception:
-        cta_files = []
-    cta_files.sort()
-    STROKE_INDEX[upper_name] = {"folder": real_name, "cta_files": cta_files}
+        return
+    index = cache_key[3]
+    for d in range(1, _PREFETCH_RADIUS + 1):
+        for i in (index + d, index - d):
+            if not 0 <= i < depth:
+                continue
+            key = cache_key[:3] + (i,) + cache_key[4:]
+            with _SLICE_CACHE_LOCK:
+                if key in _SLICE_CACHE or key in _PREFETCH_INFLIGHT:
+                    continue
+                _PREFETCH_INFLIGHT[key] = _PREFETCH_POOL.submit(_prefetch_one, path, key)
 
 
 def _case_dir(barcode: str) -> Path | None:
@@ -131,46 +372,47 @@ def create_app() -> Flask:
 
     @app.get("/api/meta")
     def meta():
-        cats = sorted({c for c in CASES_DF["cta_category"].dropna().astype(str).tolist() if c.strip() != ""})
         return jsonify(
             {
-                "total": int(len(CASES_DF)),
-                "categories": cats,
+                "total": TOTAL_COUNT,
+                "categories": CATEGORIES,
                 "stroke_root_exists": STROKE_ROOT.exists(),
             }
         )
 
     @app.get("/api/stats")
     def stats():
-        labels = LABELS.all()
-        checked_barcodes = {
-            str(k)
-            for k, v in labels.items()
-            if isinstance(v, dict) and bool(v.get("checked", False)) and str(k).strip() != ""
-        }
-
-        totals = CASES_DF["cta_category"].value_counts().to_dict()
-        df_checked = CASES_DF[CASES_DF["条码号"].isin(checked_barcodes)]
+        version = LABELS.version()
+        with _STATS_CACHE_LOCK:
+            if _STATS_CACHE["resp"] is not None and _STATS_CACHE["version"] == version:
+                return Response(_STATS_CACHE["resp"], mimetype="application/json")
+
+        # Exact barcode match, the same rule cases() and case_detail use for labels.
+        # Series.isin is hash-based (numpy's isin on object arrays is pairwise).
+        df_checked = CASES_DF[CASES_DF["条码号"].isin(LABELS.checked_barcodes())]
         checked = df_checked["cta_category"].value_counts().to_dict()
 
-        cats = sorted({c for c in CASES_DF["cta_category"].dropna().astype(str).tolist() if c.strip() != ""})
         by_category = []
-        for c in cats:
+        for c in CATEGORIES:
             by_category.append(
                 {
                     "cta_category": c,
-                    "total": int(totals.get(c, 0) or 0),
+                    "total": int(TOTALS_BY_CAT.get(c, 0) or 0),
                     "checked": int(checked.get(c, 0) or 0),
                 }
             )
 
-        return jsonify(
+        resp = jsonify(
             {
-                "total": int(len(CASES_DF)),
+                "total": TOTAL_COUNT,
                 "checked": int(len(df_checked)),
                 "by_category": by_category,
             }
         )
+        with _STATS_CACHE_LOCK:
+            _STATS_CACHE["version"] = version
+            _STATS_CACHE["resp"] = resp.get_data()  # serialized once, reused as-is
+        return resp
 
     @app.get("/api/cases")
     def cases():
@@ -184,24 +426,23 @@ def create_app() -> Flask:
             df = df[df["条码号"].str.lower().str.contains(bq, na=False)]
 
         labels = LABELS.all()
-        out = []
-        for _, r in df.iterrows():
-            barcode = str(r["条码号"])
-            idx = STROKE_INDEX.get(barcode.upper())
-            folder = idx.get("folder") if idx else None
-            cta_files = idx.get("cta_files") if idx else []
-            has_cta = bool(cta_files)
+
+        def _item(barcode: str, upper: str, cat: object) -> dict:
+            idx = STROKE_INDEX.get(upper)
             label_obj = labels.get(barcode)
-            checked = bool(label_obj.get("checked", False)) if isinstance(label_obj, dict) else False
-            out.append(
-                {
-                    "barcode": barcode,
-                    "cta_category": str(r["cta_category"] or ""),
-                    "folder": folder,
-                    "has_cta": has_cta,
-                    "checked": checked,
-                }
-            )
+            return {
+                "barcode": barcode,
+                "cta_category": str(cat or ""),
+                "folder": idx.get("folder") if idx else None,
+                "has_cta": bool(idx.get("cta_files")) if idx else False,
+                "checked": bool(label_obj.get("checked", False)) if isinstance(label_obj, dict) else False,
+            }
+
+        # Column-wise extraction: avoids building a Series per row like iterrows().
+        barcodes = df["条码号"].astype(str).tolist()
+        uppers = df["条码号"].astype(str).str.upper().tolist()
+        cats = df["cta_category"].tolist()
+        out = [_item(b, u, c) for b, u, c in zip(barcodes, uppers, cats)]
         return jsonify({"items": out})
 
     @app.get("/api/case/<barcode>")
@@ -209,10 +450,11 @@ def create_app() -> Flask:
         barcode = barcode.strip()
         if not barcode:
             return jsonify({"error": "barcode required"}), 400
-        row = CASES_DF[CASES_DF["条码号"].str.upper() == barcode.upper()]
-        category = str(row.iloc[0]["cta_category"]) if len(row) else ""
-        cta_conclusion = str(row.iloc[0].get("CTA检查结论", "")) if len(row) else ""
-        cta_findings = str(row.iloc[0].get("CTA报告：检查所见", "")) if len(row) else ""
+        row_idx = BARCODE_TO_ROW.get(barcode.upper())
+        row = CASES_DF.iloc[row_idx] if row_idx is not None else None
+        category = str(row["cta_category"]) if row is not None else ""
+        cta_conclusion = str(row.get("CTA检查结论", "")) if row is not None else ""
+        cta_findings = str(row.get("CTA报告：检查所见", "")) if row is not None else ""
 
         idx = STROKE_INDEX.get(barcode.upper())
         folder = idx.get("folder") if idx else None
@@ -220,8 +462,11 @@ def create_app() -> Flask:
         default_file = cta_files[0] if cta_files else None
         vol_info = None
         if default_file and folder:
+            default_path = str(STROKE_ROOT / folder / default_file)
+            # The UI requests the first slice right after this; start decoding now.
+            preload_volume(default_path)
             try:
-                vol_info = get_volume_info(str(STROKE_ROOT / folder / default_file))
+                vol_info = get_volume_info(default_path)
             except Exception:
                 vol_info = None
 
@@ -271,6 +516,12 @@ def create_app() -> Flask:
         rec = LABELS.set(barcode, checked)
         return jsonify({"barcode": barcode, "checked": rec.checked, "updated_at": rec.updated_at})
 
+    @app.get("/api/labels/export")
+    def export_labels():
+        resp = app.response_class(LABELS.export(), mimetype="application/json")
+        resp.headers["Content-Disposition"] = 'attachment; filename="labels.json"'
+        return resp
+
     @app.get("/api/case/<barcode>/slice")
     def slice_png(barcode: str):
         barcode = barcode.strip()
@@ -315,6 +566,10 @@ def create_app() -> Flask:
         if max_size is not None and not _env_truthy("SLICE_ALLOW_DOWNSAMPLE", "0"):
             max_size = None
 
+        fmt = "png"
+        if _SLICE_FORMAT == "webp" and "image/webp" in (request.headers.get("Accept") or ""):
+            fmt = "webp"
+
         mtime = None
         try:
             mtime = os.path.getmtime(path)
@@ -329,8 +584,25 @@ def create_app() -> Flask:
             None if window_center is None else float(window_center),
             None if window_width is None else float(window_width),
             None if max_size is None else int(max_size),
+            fmt,
         )
 
+        download_name = f"{barcode}_{file}_{axis}_{index}.{fmt}"
+        etag = _slice_cache_digest(cache_key)
+
+        def _cache_headers(resp):
+            # Allow browser caching by querystring (file/axis/index/wc/ww/max) to reduce confirms re-renders.
+            resp.headers["Cache-Control"] = "private, max-age=3600"
+            if _SLICE_FORMAT != "png":
+                resp.headers["Vary"] = "Accept"
+            resp.set_etag(etag)
+            return resp
+
+        # Revalidation: the key covers the file mtime and every render parameter,
+        # so a matching ETag means the browser's copy is current. Skip the render.
+        if request.if_none_match.contains_weak(etag):
+            return _cache_headers(app.response_class(status=304))
+
         png = None
         with _SLICE_CACHE_LOCK:
             hit = _SLICE_CACHE.get(cache_key)
@@ -338,31 +610,40 @@ def create_app() -> Flask:
                 _SLICE_CACHE.move_to_end(cache_key)
                 png = hit
 
+        disk_path = _slice_disk_path(cache_key, fmt) if png is None else None
+        if disk_path is not None:
+            # Entries are small encoded images: read them whole and promote into the
+            # memory cache, so disk hits are served exactly like memory hits. The
+            # sweep may delete the file at any time; a miss falls through to render.
+            try:
+                with open(disk_path, "rb") as f:
+                    png = f.read()
+                # Refresh mtime so the sweep evicts least-recently-used entries first.
+                os.utime(disk_path)
+            except OSError:
+                pass
+            if png is not None:
+                _slice_cache_put(cache_key, png)
+
         try:
             if png is None:
-                png = render_slice_png(
-                    str(path),
-                    axis=axis,
-                    index=index,
-                    window_center=window_center,
-                    window_width=window_width,
-                    max_size=max_size,
-                )
-                with _SLICE_CACHE_LOCK:
-                    _SLICE_CACHE[cache_key] = png
-                    _SLICE_CACHE.move_to_end(cache_key)
-                    while len(_SLICE_CACHE) > max(0, _SLICE_CACHE_MAX):
-                        _SLICE_CACHE.popitem(last=False)
+                # The same key may already be rendering on the prefetch pool.
+                png = _take_inflight(cache_key)
+            if png is None:
+                png = _render_slice_cached(path, cache_key)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+        _prefetch_neighbors(path, cache_key)
 
-        # Flask send_file needs a file-like object
-        import io
-
-        resp = send_file(io.BytesIO(png), mimetype="image/png", download_name=f"{barcode}_{file}_{axis}_{index}.png")
-        # Allow browser caching by querystring (file/axis/index/wc/ww/max) to reduce confirms re-renders.
-        resp.headers["Cache-Control"] = "private, max-age=3600"
-        return resp
+        # Bytes are already in memory: a plain Response skips send_file's file wrapper.
+        resp = Response(png, mimetype=f"image/{fmt}")
+        try:
+            download_name.encode("ascii")
+            disposition = {"filename": download_name}
+        except UnicodeEncodeError:
+            disposition = {"filename*": "UTF-8''" + quote(download_name, safe="")}
+        resp.headers.set("Content-Disposition", "inline", **disposition)
+        return _cache_headers(resp)
 
     return app
 
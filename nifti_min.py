@@ -1,18 +1,27 @@
 from __future__ import annotations
 
 import gzip
+import hashlib
 import io
 import os
 import struct
+import threading
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Literal
 
 import numpy as np
 
+try:  # Optional: fused window kernel. Falls back to plain numpy when unavailable.
+    from numba import njit
+except Exception:  # pragma: no cover
+    njit = None
+
 
 Axis = Literal["x", "y", "z"]
+ImageFormat = Literal["png", "webp"]
 
 
 _DTYPE_MAP: dict[int, str] = {
@@ -47,7 +56,10 @@ def read_nifti_header(path: str) -> NiftiHeader:
     opener = gzip.open if path.endswith(".gz") else open
     with opener(path, "rb") as f:  # type: ignore[arg-type]
         hdr = _read_exact(f, 348)
+    return _parse_header_bytes(hdr)
+
 
+def _parse_header_bytes(hdr: bytes) -> NiftiHeader:
     sizeof_hdr_le = struct.unpack("<i", hdr[0:4])[0]
     sizeof_hdr_be = struct.unpack(">i", hdr[0:4])[0]
     if sizeof_hdr_le == 348:
@@ -87,26 +99,164 @@ def read_nifti_header(path: str) -> NiftiHeader:
     )
 
 
-def _load_volume(path: str) -> tuple[NiftiHeader, np.ndarray]:
+# Decompressed copies of .nii.gz volumes. The first load inflates into memory as
+# usual and writes a plain .nii in the background; later loads memory-map that
+# copy instead of inflating again. Disabled until configure_nii_cache() is called.
+_NII_CACHE_DIR: str | None = None
+_NII_CACHE_MAX_BYTES = 0
+_NII_WRITE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nii-cache")
+
+
+def configure_nii_cache(directory: str | None, max_bytes: int) -> None:
+    global _NII_CACHE_DIR, _NII_CACHE_MAX_BYTES
+    _NII_CACHE_DIR = directory
+    _NII_CACHE_MAX_BYTES = int(max_bytes)
+
+
+def _nii_cache_path(path: str) -> str | None:
+    if not _NII_CACHE_DIR or _NII_CACHE_MAX_BYTES <= 0 or not path.endswith(".gz"):
+        return None
+    st = os.stat(path)
+    key = hashlib.sha1(f"{path}|{st.st_mtime_ns}|{st.st_size}".encode("utf-8")).hexdigest()
+    return os.path.join(_NII_CACHE_DIR, key + ".nii")
+
+
+def _write_nii_cache(target: str, head: bytes, data: bytes) -> None:
+    tmp = f"{target}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(head)
+            f.write(data)
+        os.replace(tmp, target)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+    _sweep_nii_cache()
+
+
+def _sweep_nii_cache() -> None:
+    """Delete least-recently-used copies until the directory fits its budget."""
+    entries = []
+    total = 0
+    try:
+        with os.scandir(_NII_CACHE_DIR) as it:  # type: ignore[arg-type]
+            for e in it:
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    except OSError:
+        return
+    entries.sort()
+    for _, size, fp in entries:
+        if total <= _NII_CACHE_MAX_BYTES:
+            break
+        try:
+            # Volumes already mapped stay readable after unlink.
+            os.remove(fp)
+        except OSError:
+            continue
+        total -= size
+
+
+def _map_volume(path: str) -> tuple[NiftiHeader, np.ndarray]:
+    # Uncompressed: map the voxel payload instead of copying it into RAM;
+    # slice access only pages in the bytes it touches.
     header = read_nifti_header(path)
+    expected = int(np.prod(header.shape)) * int(header.dtype.itemsize)
+    available = os.path.getsize(path) - header.vox_offset
+    if available < expected:
+        raise ValueError(f"Voxel data too small: got {max(0, available)} bytes, expected {expected}")
+    arr = np.memmap(path, dtype=header.dtype, mode="r", offset=header.vox_offset, shape=header.shape, order="F")
+    return header, arr
+
+
+def _load_volume(path: str) -> tuple[NiftiHeader, np.ndarray]:
+    nii = _nii_cache_path(path)
+    if nii is not None and os.path.exists(nii):
+        try:
+            header, arr = _map_volume(nii)
+            os.utime(nii)  # keep recently used copies through the sweep
+            return header, arr
+        except (OSError, ValueError):
+            pass
+
+    # Single pass: for .gz, reopening to seek would re-inflate the stream prefix.
     opener = gzip.open if path.endswith(".gz") else open
     with opener(path, "rb") as f:  # type: ignore[arg-type]
-        f.seek(header.vox_offset)
-        data = f.read()
+        hdr = _read_exact(f, 348)
+        header = _parse_header_bytes(hdr)
+        expected = int(np.prod(header.shape)) * int(header.dtype.itemsize)
+        pad = header.vox_offset - 348
+        extra = f.read(pad) if pad > 0 else b""
+        data = f.read(expected)
 
-    expected = int(np.prod(header.shape)) * int(header.dtype.itemsize)
     if len(data) < expected:
         raise ValueError(f"Voxel data too small: got {len(data)} bytes, expected {expected}")
-    data = data[:expected]
+
+    if nii is not None and header.vox_offset >= 348 and len(extra) == max(0, pad):
+        _NII_WRITE_POOL.submit(_write_nii_cache, nii, hdr + extra, data)
 
     arr = np.frombuffer(data, dtype=header.dtype).reshape(header.shape, order="F")
     return header, arr
 
 
-def _apply_window(slice2d: np.ndarray, center: float | None, width: float | None) -> np.ndarray:
+if njit is not None:
+
+    # No parallel=True: slices are small, and concurrent launches from request and
+    # prefetch threads are not safe under numba's default workqueue layer.
+    # fastmath without "nnan" so the NaN test below is not folded away.
+    @njit(fastmath={"contract", "afn", "reassoc"}, cache=True)
+    def _window_kernel(x, lo, hi, scale, mode, out):  # pragma: no cover - compiled
+        # mode: 0 = as is, 1 = np.rot90, 2 = np.flipud
+        m = x.shape[0]
+        n = x.shape[1]
+        for i in range(m):
+            for j in range(n):
+                v = x[i, j]
+                if v != v or v < lo:  # NaN maps to lo
+                    v = lo
+                elif v > hi:
+                    v = hi
+                if mode == 1:
+                    out[n - 1 - j, i] = np.uint8((v - lo) * scale)
+                elif mode == 2:
+                    out[m - 1 - i, j] = np.uint8((v - lo) * scale)
+                else:
+                    out[i, j] = np.uint8((v - lo) * scale)
+
+else:
+    _window_kernel = None
+
+
+def _autowindow_bounds(header: NiftiHeader, arr: np.ndarray) -> tuple[float, float]:
+    # Downsampled whole-volume percentiles, in scaled (slope/inter applied) units.
+    x = arr[::4, ::4, ::4].astype(np.float32) * float(header.scl_slope) + float(header.scl_inter)
+    lo, hi = np.percentile(x, [1, 99]).astype(np.float32)
+    if not np.isfinite(lo) or not np.isfinite(hi) or lo == hi:
+        lo, hi = float(np.min(x)), float(np.max(x))
+    return float(lo), float(hi)
+
+
+def _apply_window(
+    slice2d: np.ndarray,
+    center: float | None,
+    width: float | None,
+    auto_bounds: tuple[float, float] | None = None,
+    rot90: bool = False,
+) -> np.ndarray:
+    """Map to uint8 (C-contiguous), optionally rotated like np.rot90."""
     x = slice2d.astype(np.float32, copy=False)
 
-    if center is None or width is None or width <= 0:
+    if (center is None or width is None or width <= 0) and auto_bounds is not None:
+        lo, hi = auto_bounds
+    elif center is None or width is None or width <= 0:
         lo, hi = np.percentile(x, [1, 99]).astype(np.float32)
         if not np.isfinite(lo) or not np.isfinite(hi) or lo == hi:
             lo, hi = float(np.min(x)), float(np.max(x))
@@ -114,45 +264,157 @@ def _apply_window(slice2d: np.ndarray, center: float | None, width: float | None
         lo = float(center) - float(width) / 2.0
         hi = float(center) + float(width) / 2.0
 
-    x = np.clip(x, lo, hi)
+    out_shape = (x.shape[1], x.shape[0]) if rot90 else x.shape
     if hi == lo:
-        return np.zeros_like(x, dtype=np.uint8)
+        return np.zeros(out_shape, dtype=np.uint8)
+    if _window_kernel is not None and x.ndim == 2:
+        # One read, one uint8 write (rotation folded in); no float32 temporaries.
+        out = np.empty(out_shape, dtype=np.uint8)
+        lo32, hi32 = np.float32(lo), np.float32(hi)
+        scale = np.float32(255.0 / (float(hi) - float(lo)))
+        if rot90 and x.flags.f_contiguous and not x.flags.c_contiguous:
+            # rot90(x) == flipud(x.T) and x.T is C-contiguous: walk memory in order.
+            _window_kernel(x.T, lo32, hi32, scale, 2, out)
+        else:
+            _window_kernel(x, lo32, hi32, scale, 1 if rot90 else 0, out)
+        return out
+
+    x = np.clip(x, lo, hi)
     x = (x - lo) / (hi - lo) * 255.0
-    return x.astype(np.uint8)
+    img = x.astype(np.uint8)
+    # Rotate the uint8 result rather than the float slice: 4x less to copy.
+    return np.ascontiguousarray(np.rot90(img) if rot90 else img)
 
 
 class VolumeCache:
     def __init__(self, max_volumes: int = 2):
         self._max_volumes = max_volumes
-        self._items: "OrderedDict[str, tuple[float, NiftiHeader, np.ndarray]]" = OrderedDict()
+        # Guards _items/_loading only; loads run outside it so different volumes
+        # decompress concurrently, while callers for the same path share one load.
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, tuple[float, NiftiHeader, np.ndarray, tuple[float, float] | None]]" = OrderedDict()
+        self._loading: dict[str, threading.Event] = {}
+
+    def peek(self, path: str) -> tuple[NiftiHeader, np.ndarray] | None:
+        """Return the cached volume if resident and current; never loads."""
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self._lock:
+            hit = self._items.get(path)
+            if hit and hit[0] == mtime:
+                return hit[1], hit[2]
+        return None
+
+    def auto_bounds(self, path: str, header: NiftiHeader, arr: np.ndarray) -> tuple[float, float]:
+        """Autowindow bounds for a loaded volume, computed on first use.
+
+        Lazy so that a memory-mapped volume is not paged in just to load it.
+        """
+        with self._lock:
+            hit = self._items.get(path)
+            if hit and hit[2] is arr and hit[3] is not None:
+                return hit[3]
+        bounds = _autowindow_bounds(header, arr)
+        with self._lock:
+            hit = self._items.get(path)
+            if hit and hit[2] is arr:
+                self._items[path] = (hit[0], hit[1], hit[2], bounds)
+        return bounds
+
+    def is_loading(self, path: str) -> bool:
+        with self._lock:
+            return path in self._loading
 
     def get(self, path: str) -> tuple[NiftiHeader, np.ndarray]:
-        mtime = os.path.getmtime(path)
-        hit = self._items.get(path)
-        if hit and hit[0] == mtime:
-            self._items.move_to_end(path)
-            return hit[1], hit[2]
-
-        header, arr = _load_volume(path)
-        self._items[path] = (mtime, header, arr)
-        self._items.move_to_end(path)
-        while len(self._items) > self._max_volumes:
-            self._items.popitem(last=False)
-        return header, arr
+        while True:
+            mtime = os.path.getmtime(path)
+            with self._lock:
+                hit = self._items.get(path)
+                if hit and hit[0] == mtime:
+                    self._items.move_to_end(path)
+                    return hit[1], hit[2]
+                pending = self._loading.get(path)
+                if pending is None:
+                    done = threading.Event()
+                    self._loading[path] = done
+                    break
+            # Another thread is loading this path: wait, then re-check the cache
+            # (if that load failed, this caller retries it).
+            pending.wait()
+
+        try:
+            header, arr = _load_volume(path)
+            with self._lock:
+                self._items[path] = (mtime, header, arr, None)
+                self._items.move_to_end(path)
+                while len(self._items) > self._max_volumes:
+                    self._items.popitem(last=False)
+            return header, arr
+        finally:
+            with self._lock:
+                self._loading.pop(path, None)
+            done.set()
 
 
 _CACHE = VolumeCache(max_volumes=1)
 
+_INFO_CACHE_MAX = 128
+_INFO_CACHE: "OrderedDict[tuple[str, float], dict]" = OrderedDict()
+_INFO_CACHE_LOCK = threading.Lock()
+
+
+# Background preloads: one worker, and only the most recently requested path is
+# loaded; targets superseded while queued are dropped.
+_PRELOAD_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="volume-preload")
+_preload_target: str | None = None
+
+
+def _run_preload(path: str) -> None:
+    if _preload_target != path or _CACHE.is_loading(path):
+        return
+    try:
+        _CACHE.get(path)
+    except Exception:
+        pass
+
+
+def preload_volume(path: str) -> None:
+    """Load a volume into the cache in the background (errors are ignored)."""
+    global _preload_target
+    if _CACHE.peek(path) is not None or _CACHE.is_loading(path):
+        return
+    _preload_target = path
+    _PRELOAD_POOL.submit(_run_preload, path)
+
+
+def is_volume_cached(path: str) -> bool:
+    return _CACHE.peek(path) is not None
+
 
 def get_volume_info(path: str) -> dict:
+    key = (path, os.path.getmtime(path))
+    with _INFO_CACHE_LOCK:
+        hit = _INFO_CACHE.get(key)
+        if hit is not None:
+            _INFO_CACHE.move_to_end(key)
+            return dict(hit)
+
     header = read_nifti_header(path)
-    return {
+    info = {
         "shape": list(header.shape),
         "dtype": str(header.dtype),
         "vox_offset": header.vox_offset,
         "scl_slope": header.scl_slope,
         "scl_inter": header.scl_inter,
     }
+    with _INFO_CACHE_LOCK:
+        _INFO_CACHE[key] = info
+        _INFO_CACHE.move_to_end(key)
+        while len(_INFO_CACHE) > _INFO_CACHE_MAX:
+            _INFO_CACHE.popitem(last=False)
+    return dict(info)
 
 
 def render_slice_png(
@@ -162,8 +424,17 @@ def render_slice_png(
     window_center: float | None = None,
     window_width: float | None = None,
     max_size: int | None = None,
+    fmt: ImageFormat = "png",
+    cached_only: bool = False,
 ) -> bytes:
-    header, arr = _CACHE.get(path)
+    if cached_only:
+        # Background work must not (re)load a volume and evict the one in use.
+        hit = _CACHE.peek(path)
+        if hit is None:
+            raise LookupError(f"Volume not loaded: {path}")
+        header, arr = hit
+    else:
+        header, arr = _CACHE.get(path)
 
     if axis == "x":
         max_idx = header.shape[0] - 1
@@ -178,17 +449,27 @@ def render_slice_png(
         idx = int(np.clip(index, 0, max_idx))
         slice2d = arr[:, :, idx]
 
-    slice2d = slice2d.astype(np.float32, copy=False) * float(header.scl_slope) + float(header.scl_inter)
-    slice2d = np.rot90(slice2d)
+    # Volumes are Fortran-ordered, so z slices are F-contiguous and x/y slices are
+    # strided. astype() keeps memory order ("K"); a single float32 copy is scaled in
+    # place, and _apply_window picks a loop order matching the layout.
+    slice2d = slice2d.astype(np.float32)
+    if header.scl_slope != 1.0:
+        slice2d *= np.float32(header.scl_slope)
+    if header.scl_inter != 0.0:
+        slice2d += np.float32(header.scl_inter)
 
-    img = _apply_window(slice2d, window_center, window_width)
+    auto_bounds = None
+    if window_center is None or window_width is None or window_width <= 0:
+        auto_bounds = _CACHE.auto_bounds(path, header, arr)
+    img = _apply_window(slice2d, window_center, window_width, auto_bounds, rot90=True)
 
     try:
         from PIL import Image
     except Exception as e:  # pragma: no cover
         raise RuntimeError("Pillow is required to render PNG") from e
 
-    im = Image.fromarray(img, mode="L")
+    # img is C-contiguous uint8, so Pillow can wrap the buffer without a copy.
+    im = Image.frombuffer("L", (img.shape[1], img.shape[0]), img, "raw", "L", 0, 1)
     if max_size is not None and max_size > 0:
         w, h = im.size
         m = max(w, h)
@@ -198,6 +479,10 @@ def render_slice_png(
             nh = max(1, int(round(h * s)))
             im = im.resize((nw, nh), resample=Image.BILINEAR)
     out = io.BytesIO()
-    # Favor speed over maximum PNG compression.
-    im.save(out, format="PNG", optimize=False, compress_level=1)
+    if fmt == "webp":
+        # Opt-in alternative to PNG (SLICE_FORMAT=webp); not assumed smaller or faster.
+        im.save(out, format="WEBP", lossless=True, quality=0, method=0)
+    else:
+        # Favor speed over maximum PNG compression.
+        im.save(out, format="PNG", optimize=False, compress_level=1)
     return out.getvalue()
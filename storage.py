@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import json
 import os
+import sqlite3
+import threading
 import time
 from dataclasses import dataclass
 from typing import Any
@@ -14,47 +16,115 @@ class LabelRecord:
 
 
 class LabelStore:
-    def __init__(self, path: str):
+    """Label storage backed by SQLite (WAL mode): one row per barcode.
+
+    If the database is empty and ``legacy_json_path`` points at an existing
+    labels.json from older versions, its contents are imported once.
+    """
+
+    def __init__(self, path: str, legacy_json_path: str | None = None):
         self.path = path
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS labels ("
+            "barcode TEXT PRIMARY KEY, checked INTEGER NOT NULL, updated_at TEXT NOT NULL)"
+        )
+        # Materialized all() view, valid until the next write (ours or another process's).
         self._cache: dict[str, Any] | None = None
-        self._cache_mtime: float | None = None
-
-    def _load(self) -> dict[str, Any]:
-        if not os.path.exists(self.path):
-            self._cache = {}
-            self._cache_mtime = None
-            return {}
-        mtime = os.path.getmtime(self.path)
-        if self._cache is not None and self._cache_mtime == mtime:
-            return self._cache
-        with open(self.path, "r", encoding="utf-8") as f:
-            self._cache = json.load(f)
-            self._cache_mtime = mtime
-            return self._cache
+        self._checked: set[str] = set()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        # Bumped on every change; lets callers cache derived views.
+        self._version = 0
+        if legacy_json_path:
+            self._import_json(legacy_json_path)
 
-    def _atomic_write(self, obj: dict[str, Any]) -> None:
-        os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        tmp = self.path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2, sort_keys=True)
-        os.replace(tmp, self.path)
-        self._cache = obj
-        self._cache_mtime = os.path.getmtime(self.path)
+    def _import_json(self, json_path: str) -> None:
+        if not os.path.exists(json_path):
+            return
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM labels LIMIT 1").fetchone() is not None:
+                return
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            rows = [
+                (str(k), 1 if v.get("checked", False) else 0, str(v.get("updated_at", "")))
+                for k, v in data.items()
+                if isinstance(v, dict)
+            ]
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?, ?)", rows)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._invalidate()
+
+    def _invalidate(self) -> None:
+        self._cache = None
+        self._version += 1
+
+    def _sync(self) -> None:
+        # data_version only moves when *another* connection commits.
+        dv = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if dv != self._data_version:
+            self._data_version = dv
+            self._invalidate()
 
     def all(self) -> dict[str, Any]:
-        return self._load()
+        with self._lock:
+            self._sync()
+            if self._cache is None:
+                rows = self._conn.execute("SELECT barcode, checked, updated_at FROM labels").fetchall()
+                self._cache = {b: {"checked": bool(c), "updated_at": u} for b, c, u in rows}
+                self._checked = {b for b, c, _ in rows if c}
+            return self._cache
+
+    def checked_barcodes(self) -> frozenset[str]:
+        """Barcodes currently marked checked (maintained incrementally by set())."""
+        with self._lock:
+            self.all()
+            return frozenset(self._checked)
+
+    def version(self) -> int:
+        """Counter that changes whenever the label data changes."""
+        with self._lock:
+            self._sync()
+            return self._version
+
+    def export(self) -> str:
+        """Pretty-printed, key-sorted JSON of all labels (labels.json compatible)."""
+        with self._lock:
+            data = dict(self.all())
+        return json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True)
 
     def get(self, barcode: str) -> LabelRecord | None:
-        obj = self._load().get(barcode)
-        if not isinstance(obj, dict):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT checked, updated_at FROM labels WHERE barcode = ?", (barcode,)
+            ).fetchone()
+        if row is None:
             return None
-        checked = bool(obj.get("checked", False))
-        updated_at = str(obj.get("updated_at", ""))
-        return LabelRecord(checked=checked, updated_at=updated_at)
+        return LabelRecord(checked=bool(row[0]), updated_at=str(row[1]))
 
     def set(self, barcode: str, checked: bool) -> LabelRecord:
         now = time.strftime("%Y-%m-%d %H:%M:%S")
-        data = self._load()
-        data[barcode] = {"checked": bool(checked), "updated_at": now}
-        self._atomic_write(data)
+        with self._lock:
+            self._sync()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO labels (barcode, checked, updated_at) VALUES (?, ?, ?)",
+                (barcode, 1 if checked else 0, now),
+            )
+            # Patch the materialized view in place rather than re-reading the table.
+            if self._cache is not None:
+                self._cache[barcode] = {"checked": bool(checked), "updated_at": now}
+                if checked:
+                    self._checked.add(barcode)
+                else:
+                    self._checked.discard(barcode)
+            self._version += 1
         return LabelRecord(checked=bool(checked), updated_at=now)